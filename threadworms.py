@@ -8,15 +8,24 @@
 # This is meant to be an educational example of multithreaded programming,
 # so I get kind of verbose in the comments.
 
-import random, pygame, sys, threading
+import random, pygame, sys, threading, time, os, subprocess, collections
 from pygame.locals import *
 
+# time.monotonic() is a clock that can't go backwards (unlike time.time(),
+# which jumps if the system clock is changed), so it is the right clock to
+# schedule worm movements with. Python 2 doesn't have it, so fall back on
+# time.time() there.
+monotonic = getattr(time, 'monotonic', time.time)
+
 # Setting up constants
 NUM_WORMS = 24  # the number of worms in the grid
 FPS = 30        # frames per second that the program runs
 CELL_SIZE = 20  # how many pixels wide and high each "cell" in the grid is
 CELLS_WIDE = 32 # how many cells wide the grid is
 CELLS_HIGH = 24 # how many cells high the grid is
+MAX_CATCH_UP_MOVES = 3 # how many missed moves a worm will rush to make up after being stalled
+CHECK_GRID = False     # if True, a thread keeps checking that the worms never overlap (see checkGrid())
+CHECK_GRID_INTERVAL = 0.1 # seconds between each check of the grid
 
 
 # Create the global grid data structure. GRID[x][y] contains None for empty
@@ -39,6 +48,11 @@ for x in range(CELLS_WIDE):
         column.append(threading.Lock()) # create one Lock object for each cell
     GRID_LOCKS.append(column)
 
+# The (x, y) tuples of cells that setGridSquares() filled in. These cells are
+# occupied but aren't part of any worm. Like GRID, only change this set while
+# holding the cell's lock.
+WALL_CELLS = set()
+
 # Constants for some colors.
 #             R    G    B
 WHITE     = (255, 255, 255)
@@ -51,6 +65,17 @@ GRID_LINES_COLOR = DARKGRAY # color to use for the lines of the grid
 WINDOWWIDTH = CELL_SIZE * CELLS_WIDE
 WINDOWHEIGHT = CELL_SIZE * CELLS_HIGH
 
+# Settings for running without a window and saving the frames instead.
+HEADLESS = False        # if True, draw to an offscreen surface instead of a window
+HEADLESS_FRAMES = 300   # how many frames to draw before quitting when HEADLESS is True
+EXPORT_FORMAT = None    # None to not export frames, 'png' for a PNG sequence, or 'raw' to pipe RGB frames to EXPORT_COMMAND
+EXPORT_DIR = 'frames'   # the folder the PNG sequence is saved to
+EXPORT_COMMAND = ['ffmpeg', '-y', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                  '-s', '%sx%s' % (WINDOWWIDTH, WINDOWHEIGHT), '-r', str(FPS),
+                  '-i', '-', 'threadworms.mp4'] # the encoder that 'raw' frames are piped to
+EXPORT_QUEUE_SIZE = 60  # how many frames can wait to be encoded before EXPORT_FULL_POLICY kicks in
+EXPORT_FULL_POLICY = 'drop-oldest' # 'drop-newest', 'drop-oldest', or 'replace-newest' (see FrameExporter.addFrame())
+
 # Constants for the four cardinal directions, because a mistyped variable
 # like DWON will cause an immediate NameError crash and be easy to spot. But a
 # mistyped string like 'dwon' is still syntactically valid Python code, so
@@ -84,25 +109,31 @@ class Worm(threading.Thread): # "Thread" is a class in the "threading" module.
 
         self.name = name
 
+        # Each worm gets its own random number generator instead of sharing
+        # the one in the random module. The shared generator is itself shared
+        # data that every thread would have to take turns using, and on a
+        # free-threaded Python (one without the GIL) that is a bottleneck.
+        self.random = random.Random()
+
         # Set the maxsize to the parameter, or to a random maxsize.
         if maxsize is None:
-            self.maxsize = random.randint(4, 10)
+            self.maxsize = self.random.randint(4, 10)
 
             # Have a small chance of a super long worm.
-            if random.randint(0,4) == 0:
-                self.maxsize += random.randint(10, 20)
+            if self.random.randint(0,4) == 0:
+                self.maxsize += self.random.randint(10, 20)
         else:
             self.maxsize = maxsize
 
         # Set the color to the parameter, or to a random color.
         if color is None:
-            self.color = (random.randint(60, 255), random.randint(60, 255), random.randint(60, 255))
+            self.color = (self.random.randint(60, 255), self.random.randint(60, 255), self.random.randint(60, 255))
         else:
             self.color = color
 
         # Set the speed to the parameter, or to a random number.
         if speed is None:
-            self.speed = random.randint(20, 500) # wait time before movements will be between 0.02 and 0.5 seconds
+            self.speed = self.random.randint(20, 500) # wait time before movements will be between 0.02 and 0.5 seconds
         else:
             self.speed = speed
 
@@ -110,8 +141,8 @@ class Worm(threading.Thread): # "Thread" is a class in the "threading" module.
         # it is unoccupied.)
         # As the worm begins to move, new segments will be added until it reaches full length.
         while True:
-            startx = random.randint(0, CELLS_WIDE - 1)
-            starty = random.randint(0, CELLS_HIGH - 1)
+            startx = self.random.randint(0, CELLS_WIDE - 1)
+            starty = self.random.randint(0, CELLS_HIGH - 1)
             # This thread will wait until the Lock in GRID_LOCKS is released
             # (if it is currently acquired by a different thread). If another thread
             # has currently acquired the lock, the acquire() call will not return
@@ -122,6 +153,7 @@ class Worm(threading.Thread): # "Thread" is a class in the "threading" module.
             GRID_LOCKS[startx][starty].acquire() # block until this thread can acquire the lock
             if GRID[startx][starty] is None:
                 break # we've found an unoccupied cell in the grid
+            GRID_LOCKS[startx][starty].release() # this cell is taken, so let go of its lock and try another one
 
         GRID[startx][starty] = self.color # modify the shared data structure
 
@@ -133,7 +165,15 @@ class Worm(threading.Thread): # "Thread" is a class in the "threading" module.
         # The worm's body starts as a single segment, and keeps growing until it
         # reaches full length. This makes setup easier.
         self.body = [{'x': startx, 'y': starty}]
-        self.direction = random.choice((UP, DOWN, LEFT, RIGHT))
+        self.direction = self.random.choice((UP, DOWN, LEFT, RIGHT))
+
+        # Keep track of how many moves the worm has made since it started
+        # running, so we can compare how fast it actually moved against how
+        # fast it was supposed to move. (See getMoveRates().)
+        self.movesMade = 0
+        self.startTime = None
+        self.stopTime = None
+        self.nextMoveTime = None
 
 
     def run(self):
@@ -146,28 +186,24 @@ class Worm(threading.Thread): # "Thread" is a class in the "threading" module.
         # code that displays the worms in 3D without changing the Worm class's
         # code at all. The visualization code just has to read the GRID variable
         # (in a thread-safe manner by using GRID_LOCKS, of course).
+        self.startTime = monotonic()
+        self.nextMoveTime = self.startTime # the time the worm is scheduled to make its next move
         while True:
             if not WORMS_RUNNING:
+                self.stopTime = monotonic() # so getMoveRates() doesn't count the time after the worm stopped
                 return # A thread terminates when run() returns.
 
             # Randomly decide to change direction
-            if random.randint(0, 100) < 20: # 20% to change direction
-                self.direction = random.choice((UP, DOWN, LEFT, RIGHT))
+            if self.random.randint(0, 100) < 20: # 20% to change direction
+                self.direction = self.random.choice((UP, DOWN, LEFT, RIGHT))
 
             nextx, nexty = self.getNextPosition()
 
-            # We are going to make modifications to GRID, so we need to acquire
-            # the lock first.
-            origx, origy = nextx, nexty
-            if origx not in (-1, CELLS_WIDE) and origy not in (-1, CELLS_HIGH):
-                gotLock = GRID_LOCKS[origx][origy].acquire(timeout=1) # don't return (that is, block) until this thread can acquire the lock
-                if not gotLock:
-                    continue
-
-            # Really, we should check if nextx < 0 or nextx >= CELLS_WIDE, but
-            # since worms only move one space at a time, we can get away with
-            # just checking if they are at -1 or CELLS_WIDE/CELLS_HIGH.
-            if nextx in (-1, CELLS_WIDE) or nexty in (-1, CELLS_HIGH) or GRID[nextx][nexty] is not None:
+            # Try to claim the cell the worm is heading towards. If this
+            # returns True, we are holding that cell's lock, so no other
+            # thread can move into the cell before we do.
+            gotCell = self.acquireFreeCell(nextx, nexty)
+            if not gotCell:
                 # The space the worm is heading towards is taken, so find a new direction.
                 self.direction = self.getNewDirection()
 
@@ -177,34 +213,42 @@ class Worm(threading.Thread): # "Thread" is a class in the "threading" module.
                     self.direction = self.getNewDirection()
 
                 if self.direction is not None:
-                    # It is possible to move in some direction, so reask for the next postion.
+                    # It is possible to move in some direction, so reask for
+                    # the next postion. getNewDirection() released its locks
+                    # before returning, so another worm could have moved into
+                    # that cell since then. That's why we have to try to claim
+                    # it again instead of assuming it is still free.
                     nextx, nexty = self.getNextPosition()
-            if origx not in (-1, CELLS_WIDE) and origy not in (-1, CELLS_HIGH):
-                GRID_LOCKS[origx][origy].release()
-
+                    gotCell = self.acquireFreeCell(nextx, nexty)
 
-            if self.direction is not None:
-                GRID_LOCKS[nextx][nexty].acquire()
-                # Space on the grid is free, so move there.
+            if gotCell:
+                # Space on the grid is free, so move there. We update GRID and
+                # the worm's own body while still holding the cell's lock, so
+                # that a thread holding the locks (like checkGrid()) never sees
+                # one changed without the other.
                 GRID[nextx][nexty] = self.color # update the GRID state
-                GRID_LOCKS[nextx][nexty].release()
                 self.body.insert(0, {'x': nextx, 'y': nexty}) # update this worm's own state
+                GRID_LOCKS[nextx][nexty].release()
+                self.movesMade += 1
 
                 # Check if we've grown too long, and cut off tail if we have.
                 # This gives the illusion of the worm moving.
-
-                # TODO - here's where our bug is. Sometimes the worms are still growing but they run into each other. This is what holds up their threads.
-                if len(self.body) > self.maxsize:
-                    # TODO - something weird is going on here. Doing the sepukku routine lets us quit cleanly, but the worm still appears drawn on the screen.
-                    gotLock = GRID_LOCKS[self.body[BUTT]['x']][self.body[BUTT]['y']].acquire(timeout=2)
+                # This is a loop because an earlier move might have left the
+                # worm more than one segment too long.
+                while len(self.body) > self.maxsize:
+                    buttx = self.body[BUTT]['x']
+                    butty = self.body[BUTT]['y']
+                    gotLock = GRID_LOCKS[buttx][butty].acquire(timeout=2)
                     if not gotLock:
-                        self.maxsize -= 1 # TODO - not entirely sure why this imrpoves the framerate.
-                        #print('chop %s' % (self.name))
-                    GRID[self.body[BUTT]['x']][self.body[BUTT]['y']] = None # update the GRID state
-                    GRID_LOCKS[self.body[BUTT]['x']][self.body[BUTT]['y']].release()
+                        # We must not touch GRID (or release a lock we don't
+                        # hold), so the worm stays too long for now and we'll
+                        # chop the extra segments after the next move.
+                        break
+                    GRID[buttx][butty] = None # update the GRID state
                     del self.body[BUTT] # update this worm's own state (heh heh, worm butt)
+                    GRID_LOCKS[buttx][butty].release()
             else:
-                self.direction = random.choice((UP, DOWN, LEFT, RIGHT)) # can't move, so just do nothing for now but set a new random direction
+                self.direction = self.random.choice((UP, DOWN, LEFT, RIGHT)) # can't move, so just do nothing for now but set a new random direction
 
             # On a technical note, a worm could get stuck inside itself if its
             # head and butt are in this pattern:
@@ -217,14 +261,13 @@ class Worm(threading.Thread): # "Thread" is a class in the "threading" module.
             # moving with 0 speed overnight, but I didn't see any of these worm
             # knots form, so I'm guessing it is super rare.
 
-            # Pygame's pygame.time.wait() and the Python Standard Library's
-            # time.time() functions (and the tick() method) are smart enough
-            # to tell the operating system to put the thread to sleep for a
-            # while and just run other threads instead. Of course, while the
-            # OS could interrupt our thread at any time to hand execution off
-            # to a different thread, calling wait() or sleep() is a way we can
-            # explicitly say, "Go ahead and don't run this thread for X
-            # milliseconds."
+            # Python's time.sleep() and Pygame's pygame.time.wait() functions
+            # (and the tick() method) are smart enough to tell the operating
+            # system to put the thread to sleep for a while and just run other
+            # threads instead. Of course, while the OS could interrupt our
+            # thread at any time to hand execution off to a different thread,
+            # calling wait() or sleep() is a way we can explicitly say, "Go
+            # ahead and don't run this thread for X seconds."
             #
             # This wouldn't happen if we have "wait" code like this:
             # startOfWait = time.time()
@@ -240,11 +283,28 @@ class Worm(threading.Thread): # "Thread" is a class in the "threading" module.
             # Of course, if ALL worms' threads are sleeping, then the computer
             # can know it can use the CPU to run other programs besides
             # our Python Threadworms script.
-            pygame.time.wait(self.speed)
+            #
+            # We don't just sleep for self.speed milliseconds though. The code
+            # above took some time to run (especially if we had to wait for
+            # another thread to release a lock), and if we always slept the full
+            # amount on top of that, the worm would move slower than it's
+            # supposed to. Instead, each worm keeps a "deadline" for its next
+            # move and only sleeps for whatever time is left until then.
+            self.nextMoveTime += self.speed / 1000.0
+            now = monotonic()
+
+            # If the worm got stalled for a long time, it is way behind its
+            # schedule. We let it make up to MAX_CATCH_UP_MOVES of the missed
+            # moves by not sleeping, and forget about any moves missed before
+            # that. Otherwise the worm would zip across the screen trying to
+            # catch up.
+            self.nextMoveTime = max(self.nextMoveTime, now - MAX_CATCH_UP_MOVES * self.speed / 1000.0)
+
+            time.sleep(max(self.nextMoveTime - now, 0))
 
             # The beauty of using multiple threads here is that we can have
-            # the worms move at different rates of speed just by passing a
-            # different integer to wait().
+            # the worms move at different rates of speed just by having
+            # different deadlines to sleep until.
             # If we did this program in a single thread, we would have to
             # calculate how often we update the position of each worm based
             # on their speed relative to all the other worms, which would
@@ -252,6 +312,27 @@ class Worm(threading.Thread): # "Thread" is a class in the "threading" module.
             # for us!
 
 
+    def getMoveRates(self):
+        # Return a tuple of the moves per second this worm was configured to
+        # make, and the moves per second it actually made. A speed of 0 means
+        # "as fast as possible", so the target rate is infinity in that case.
+        if self.speed == 0:
+            targetRate = float('inf')
+        else:
+            targetRate = 1000.0 / self.speed
+
+        if self.startTime is None:
+            return targetRate, 0.0 # the worm hasn't started running yet
+
+        if self.stopTime is None:
+            elapsed = monotonic() - self.startTime # the worm is still running
+        else:
+            elapsed = self.stopTime - self.startTime
+        if elapsed <= 0:
+            return targetRate, 0.0
+        return targetRate, self.movesMade / elapsed
+
+
     def getNextPosition(self):
         # Figure out the x and y of where the worm's head would be next, based
         # on the current position of its "head" and direction member.
@@ -277,28 +358,242 @@ class Worm(threading.Thread): # "Thread" is a class in the "threading" module.
         return nextx, nexty
 
 
+    def acquireFreeCell(self, x, y):
+        # Acquire the lock for the cell at x, y and return True if the cell is
+        # on the grid and empty. The caller must release the lock when it's
+        # done with the cell. Otherwise, return False without holding the lock.
+
+        # Really, we should check if x < 0 or x >= CELLS_WIDE, but since worms
+        # only move one space at a time, we can get away with just checking if
+        # they are at -1 or CELLS_WIDE/CELLS_HIGH.
+        if x in (-1, CELLS_WIDE) or y in (-1, CELLS_HIGH):
+            return False
+
+        gotLock = GRID_LOCKS[x][y].acquire(timeout=1)
+        if not gotLock:
+            return False # some other thread has been holding it a while, so treat the cell as taken
+        if GRID[x][y] is not None:
+            GRID_LOCKS[x][y].release()
+            return False
+        return True
+
+
+    def isFreeCell(self, x, y):
+        # Return True if the cell at x, y is on the grid and empty. Even
+        # reading GRID has to be done while holding the cell's lock. With the
+        # GIL, we'd usually get away without it. Without the GIL, another
+        # thread can be writing to the same list at the exact same moment.
+        if not self.acquireFreeCell(x, y):
+            return False
+        GRID_LOCKS[x][y].release()
+        return True
+
+
     def getNewDirection(self):
         x = self.body[HEAD]['x'] # syntactic sugar, makes the code below more readable
         y = self.body[HEAD]['y']
 
         # Compile a list of possible directions the worm can move.
         newDirection = []
-        if y - 1 not in (-1, CELLS_HIGH) and GRID[x][y - 1] is None:
+        if self.isFreeCell(x, y - 1):
             newDirection.append(UP)
-        if y + 1 not in (-1, CELLS_HIGH) and GRID[x][y + 1] is None:
+        if self.isFreeCell(x, y + 1):
             newDirection.append(DOWN)
-        if x - 1 not in (-1, CELLS_WIDE) and GRID[x - 1][y] is None:
+        if self.isFreeCell(x - 1, y):
             newDirection.append(LEFT)
-        if x + 1 not in (-1, CELLS_WIDE) and GRID[x + 1][y] is None:
+        if self.isFreeCell(x + 1, y):
             newDirection.append(RIGHT)
 
         if newDirection == []:
             return None # None is returned when there are no possible ways for the worm to move.
 
-        return random.choice(newDirection)
+        return self.random.choice(newDirection)
+
+class GridCheckError(Exception):
+    # Raised by checkGrid() when the worms and GRID don't match up. This is
+    # its own exception instead of an assert statement, because running
+    # Python with -O removes assert statements, and then the check would
+    # always pass.
+    pass
+
+
+class GridChecker(threading.Thread):
+    def __init__(self, worms, interval=CHECK_GRID_INTERVAL):
+        # worms is the list of Worm objects whose bodies should match GRID.
+        # interval is how many seconds to wait between checks.
+        threading.Thread.__init__(self)
+
+        self.name = 'GridChecker'
+        self.worms = worms
+        self.interval = interval
+        self.checksDone = 0
+        self.failure = None # set to the error message if a check fails
+
+
+    def run(self):
+        # Keep checking the grid until the worms stop or a check fails. Bugs
+        # in multithreaded code often only show up once in a blue moon, so
+        # checking over and over while the worms run gives us a much better
+        # chance of catching one than checking once at the end.
+        while WORMS_RUNNING:
+            try:
+                checkGrid(self.worms)
+            except GridCheckError as err:
+                self.failure = str(err)
+                print('Grid check failed: %s' % (self.failure))
+                return
+            self.checksDone += 1
+            time.sleep(self.interval)
+
+
+class FrameExporter(threading.Thread):
+    def __init__(self, exportFormat, queueSize=EXPORT_QUEUE_SIZE, fullPolicy=EXPORT_FULL_POLICY):
+        # exportFormat is 'png' to save a PNG sequence in EXPORT_DIR, or 'raw'
+        # to pipe raw RGB frames to the encoder program in EXPORT_COMMAND.
+        # queueSize is the most frames that can wait to be encoded.
+        # fullPolicy is what addFrame() does when the queue is full.
+        threading.Thread.__init__(self)
+
+        assert exportFormat in ('png', 'raw'), 'Bad value for exportFormat: %s' % exportFormat
+        assert fullPolicy in ('drop-newest', 'drop-oldest', 'replace-newest'), 'Bad value for fullPolicy: %s' % fullPolicy
+
+        self.name = 'FrameExporter'
+        self.exportFormat = exportFormat
+        self.queueSize = queueSize
+        self.fullPolicy = fullPolicy
+
+        # Saving a PNG file or writing to a pipe can take a while, and we
+        # never want the main thread to sit around waiting for the disk. So
+        # the main thread just copies each frame's pixels into this queue, and
+        # this thread does the slow work of saving them.
+        #
+        # The frames deque is shared by both threads, so it has its own lock.
+        # A Condition object is a lock that also lets this thread go to sleep
+        # until the main thread wakes it up with notify() (meaning "there's
+        # a new frame for you").
+        self.frames = collections.deque()
+        self.framesCondition = threading.Condition()
+        self.finished = False
+
+        self.framesWritten = 0
+        self.framesDropped = 0
+        self.failure = None # set to the error message if saving the frames failed
+
+
+    def addFrame(self, surface):
+        # Copy the pixels of surface into the queue. This is called by the
+        # main thread, so it must never block on disk I/O.
+        frame = pygame.image.tostring(surface, 'RGB')
+
+        self.framesCondition.acquire()
+        if self.failure is not None:
+            # The exporter has stopped, so don't fill up the queue for nothing.
+            self.framesDropped += 1
+            frame = None
+        elif len(self.frames) >= self.queueSize:
+            # The encoder can't keep up, so we have to lose a frame somewhere:
+            #   'drop-newest' throws away this new frame.
+            #   'drop-oldest' throws away the frame that has waited longest.
+            #   'replace-newest' throws away the newest queued frame and puts
+            #       this one in its place, so the end of the queue is always
+            #       the latest grid.
+            if self.fullPolicy == 'drop-newest':
+                self.framesDropped += 1
+                frame = None
+            elif self.fullPolicy == 'drop-oldest':
+                self.framesDropped += 1
+                self.frames.popleft()
+            elif self.fullPolicy == 'replace-newest':
+                self.framesDropped += 1
+                self.frames.pop()
+        if frame is not None:
+            self.frames.append(frame)
+            self.framesCondition.notify() # wake up this thread if it's waiting for a frame
+        self.framesCondition.release()
+
+
+    def run(self):
+        # If the frames can't be saved (say, the disk is full or the encoder
+        # program isn't installed), remember why and stop. We can't raise an
+        # exception in the main thread from here, so addFrame() and finish()
+        # check self.failure instead.
+        encoder = None
+        failure = None
+        try:
+            if self.exportFormat == 'png':
+                if not os.path.exists(EXPORT_DIR):
+                    os.makedirs(EXPORT_DIR)
+            else:
+                encoder = subprocess.Popen(EXPORT_COMMAND, stdin=subprocess.PIPE)
+            self.writeFrames(encoder)
+            if encoder is not None:
+                encoder.stdin.close() # tells the encoder there are no more frames
+                if encoder.wait() != 0:
+                    failure = '%s exited with code %s' % (EXPORT_COMMAND[0], encoder.returncode)
+        except (IOError, OSError, pygame.error) as err:
+            failure = str(err)
+            if encoder is not None:
+                encoder.kill()
+                encoder.wait()
+
+        if failure is not None:
+            # Set self.failure while holding the lock, so that addFrame() can't
+            # queue a frame after we've thrown away the ones still waiting.
+            self.framesCondition.acquire()
+            self.failure = failure
+            self.framesDropped += len(self.frames)
+            self.frames.clear()
+            self.framesCondition.release()
+            print('Frame export failed: %s' % (self.failure))
+
+
+    def writeFrames(self, encoder):
+        # Save frames from the queue until finish() is called and the queue
+        # is empty.
+        while True:
+            self.framesCondition.acquire()
+            while len(self.frames) == 0 and not self.finished:
+                self.framesCondition.wait() # releases the lock while sleeping, and reacquires it when woken up
+            if len(self.frames) == 0:
+                # finish() was called and every frame has been written.
+                self.framesCondition.release()
+                return
+            frame = self.frames.popleft()
+            self.framesCondition.release()
+
+            # Do the slow part after releasing the lock, so addFrame() can keep
+            # adding frames while we write this one.
+            try:
+                if self.exportFormat == 'png':
+                    frameSurf = pygame.image.fromstring(frame, (WINDOWWIDTH, WINDOWHEIGHT), 'RGB')
+                    pygame.image.save(frameSurf, os.path.join(EXPORT_DIR, 'frame%05d.png' % self.framesWritten))
+                else:
+                    encoder.stdin.write(frame)
+            except (IOError, OSError, pygame.error):
+                # This frame is lost too, so count it before run() handles the error.
+                self.framesCondition.acquire()
+                self.framesDropped += 1
+                self.framesCondition.release()
+                raise
+            self.framesWritten += 1
+
+
+    def finish(self):
+        # Tell the thread to write out the rest of the queue and then stop,
+        # and wait until it has done so.
+        self.framesCondition.acquire()
+        self.finished = True
+        self.framesCondition.notify()
+        self.framesCondition.release()
+        self.join()
+        if self.failure is not None:
+            print('Frame export failed after %s frames (%s dropped): %s' % (self.framesWritten, self.framesDropped, self.failure))
+        else:
+            print('Exported %s frames (%s dropped).' % (self.framesWritten, self.framesDropped))
+
 
 def main():
-    global FPSCLOCK, DISPLAYSURF
+    global FPSCLOCK, DISPLAYSURF, FRAME_EXPORTER
 
     # Draw some walls on the grid
     squares = """
@@ -322,10 +617,23 @@ def main():
     #setGridSquares(squares)
 
     # Pygame window set up.
+    if HEADLESS:
+        os.environ['SDL_VIDEODRIVER'] = 'dummy' # let Pygame run on computers without a screen
     pygame.init()
     FPSCLOCK = pygame.time.Clock()
-    DISPLAYSURF = pygame.display.set_mode((WINDOWWIDTH, WINDOWHEIGHT))
-    pygame.display.set_caption('Threadworms')
+    if HEADLESS:
+        # A Surface that isn't the display is drawn on just like the window,
+        # but it only exists in memory.
+        DISPLAYSURF = pygame.Surface((WINDOWWIDTH, WINDOWHEIGHT))
+    else:
+        DISPLAYSURF = pygame.display.set_mode((WINDOWWIDTH, WINDOWHEIGHT))
+        pygame.display.set_caption('Threadworms')
+
+    # Start the thread that saves frames.
+    FRAME_EXPORTER = None
+    if EXPORT_FORMAT is not None:
+        FRAME_EXPORTER = FrameExporter(EXPORT_FORMAT)
+        FRAME_EXPORTER.start()
 
     # Create the worm objects.
     worms = [] # a list that contains all the worm objects
@@ -333,24 +641,67 @@ def main():
         worms.append(Worm(name='Worm %s' % i))
         worms[-1].start() # Start the worm code in its own thread.
 
+    if CHECK_GRID:
+        GridChecker(worms).start()
+
     DISPLAYSURF.fill(BGCOLOR)
+    framesDrawn = 0
     while True: # main game loop
-        handleEvents()
+        if HEADLESS:
+            # There's no window to close, so quit after enough frames.
+            if framesDrawn >= HEADLESS_FRAMES:
+                terminate(worms)
+        else:
+            handleEvents(worms)
         drawGrid()
+        framesDrawn += 1
 
-        pygame.display.update()
+        if FRAME_EXPORTER is not None:
+            FRAME_EXPORTER.addFrame(DISPLAYSURF)
+        if not HEADLESS:
+            pygame.display.update()
         FPSCLOCK.tick(FPS)
 
 
-def handleEvents():
+def handleEvents(worms):
     # The only event we need to handle in this program is when it terminates.
-    global WORMS_RUNNING
-
     for event in pygame.event.get(): # event handling loop
         if (event.type == QUIT) or (event.type == KEYDOWN and event.key == K_ESCAPE):
-            WORMS_RUNNING = False # Setting this to False tells the Worm threads to exit.
-            pygame.quit()
-            sys.exit()
+            terminate(worms)
+
+
+def terminate(worms):
+    global WORMS_RUNNING
+
+    WORMS_RUNNING = False # Setting this to False tells the Worm threads to exit.
+
+    # Wait for every worm to notice and stop, so that getMoveRates() uses the
+    # time each worm actually stopped. A worm sleeps for at most its speed in
+    # milliseconds, so this doesn't take long.
+    for worm in worms:
+        worm.join()
+
+    if FRAME_EXPORTER is not None:
+        FRAME_EXPORTER.finish() # wait for the queued frames to be saved
+    printMoveRates(worms)
+    pygame.quit()
+    sys.exit()
+
+
+def printMoveRates(worms):
+    # Print how many moves per second each worm was supposed to make and how
+    # many it actually made. The more worms (and threads) there are, the
+    # more time they spend waiting on each other's locks, and the further
+    # behind their target rates they can fall.
+    print('Worm          Target moves/sec  Achieved moves/sec')
+    totalTarget = 0.0
+    totalAchieved = 0.0
+    for worm in worms:
+        targetRate, achievedRate = worm.getMoveRates()
+        totalTarget += targetRate
+        totalAchieved += achievedRate
+        print('%-12s  %16.1f  %18.1f' % (worm.name, targetRate, achievedRate))
+    print('%-12s  %16.1f  %18.1f' % ('Total', totalTarget, totalAchieved))
 
 
 def drawGrid():
@@ -410,12 +761,69 @@ def setGridSquares(squares, color=(192, 192, 192)):
             GRID_LOCKS[x][y].acquire()
             if squares[y][x] == ' ':
                 GRID[x][y] = None
+                WALL_CELLS.discard((x, y))
             elif squares[y][x] == '.':
                 pass
             else:
                 GRID[x][y] = color
+                WALL_CELLS.add((x, y))
+            GRID_LOCKS[x][y].release()
+
+
+def clearGrid():
+    # Set every cell in the grid to empty. The worms that were on the grid
+    # should have stopped running before this is called.
+    for x in range(CELLS_WIDE):
+        for y in range(CELLS_HIGH):
+            GRID_LOCKS[x][y].acquire()
+            GRID[x][y] = None
+            WALL_CELLS.discard((x, y))
             GRID_LOCKS[x][y].release()
 
 
+def checkGrid(worms):
+    # Raise a GridCheckError unless every occupied cell in GRID belongs to
+    # exactly one worm's body (or is a wall), and every worm body segment is
+    # on a cell that GRID says is occupied by that worm's color.
+    #
+    # To get a snapshot of the grid and the worm bodies that all match each
+    # other, we hold every lock in GRID_LOCKS at once. The worms only change
+    # GRID and their bodies while holding a cell's lock, so none of them can
+    # be halfway through a move while we look.
+    #
+    # Holding more than one lock at a time is how deadlocks happen: if thread
+    # A holds lock 1 and waits for lock 2 while thread B holds lock 2 and waits
+    # for lock 1, both threads wait forever. We avoid that here because the
+    # worms never hold one cell's lock while waiting for another, and we always
+    # acquire the locks in the same order.
+    for x in range(CELLS_WIDE):
+        for y in range(CELLS_HIGH):
+            GRID_LOCKS[x][y].acquire()
+    gridCopy = [column[:] for column in GRID]
+    bodies = [(worm, list(worm.body)) for worm in worms]
+    walls = set(WALL_CELLS)
+    for x in range(CELLS_WIDE):
+        for y in range(CELLS_HIGH):
+            GRID_LOCKS[x][y].release()
+
+    # Now that we have a snapshot, check it without holding up the worms.
+    owners = {} # keys are (x, y) tuples, values are the worm whose body is there
+    for worm, body in bodies:
+        for segment in body:
+            cell = (segment['x'], segment['y'])
+            if cell in owners:
+                raise GridCheckError('Cell %s is in the body of both %s and %s' % (cell, owners[cell].name, worm.name))
+            if cell in walls:
+                raise GridCheckError('Cell %s is in the body of %s but is a wall' % (cell, worm.name))
+            if gridCopy[cell[0]][cell[1]] != worm.color:
+                raise GridCheckError('Cell %s is in the body of %s but GRID has %s' % (cell, worm.name, gridCopy[cell[0]][cell[1]]))
+            owners[cell] = worm
+
+    for x in range(CELLS_WIDE):
+        for y in range(CELLS_HIGH):
+            if gridCopy[x][y] is not None and (x, y) not in owners and (x, y) not in walls:
+                raise GridCheckError('Cell %s is occupied but is not in any worm body' % ((x, y),))
+
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
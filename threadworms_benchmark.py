@@ -0,0 +1,177 @@
+#! python3
+
+# Threadworms scaling benchmark
+# By Al Sweigart al@inventwithpython.com
+# http://inventwithpython.com/blog
+# Released under a "Simplified BSD" license
+
+# This runs the worms from threadworms.py with no window and no waiting
+# between moves, and counts how many moves per second they make in total with
+# 1, 2, 4, 8, 16, and 32 worm threads.
+#
+# On regular Python, only one thread can run Python code at a time because of
+# the GIL (Global Interpreter Lock), so adding more threads doesn't make the
+# worms move any faster in total. Free-threaded Python (the "python3.13t"
+# build and later) can run without the GIL, so the threads can run on
+# multiple CPU cores at the same time. On a free-threaded Python, this script
+# runs the benchmark twice, once with the GIL turned on (-X gil=1) and once
+# with it off (-X gil=0), so you can compare them.
+#
+# Run it like this:
+#     python threadworms_benchmark.py [other_python ...]
+# Each other_python is the path to another Python interpreter (such as
+# python3.13t) to also run the benchmark with.
+#
+# A benchmark that goes fast because it's broken isn't worth much, so for
+# each thread count the worms also do a separate verification run with a
+# GridChecker thread checking that no two worms ever end up in the same cell.
+# That run isn't timed, because checkGrid() holds up every worm while it
+# looks at the grid, which would slow down the moves/sec we're measuring.
+
+import os, subprocess, sys, time
+import threadworms
+
+THREAD_COUNTS = (1, 2, 4, 8, 16, 32) # the numbers of worm threads to try
+SECONDS_PER_RUN = 3 # how long to let the worms run for each thread count
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        # We were started by the code below to run the benchmark in this
+        # interpreter, so print the results for the parent to read.
+        #
+        # First print whether the GIL is really off. If some module turned it
+        # back on, the free-threaded numbers would quietly be GIL numbers.
+        # (Python versions before 3.13 don't have sys._is_gil_enabled(), and
+        # they always have the GIL.)
+        gilEnabled = getattr(sys, '_is_gil_enabled', lambda: True)()
+        print('RESULT gil %s' % (gilEnabled))
+        for numThreads in THREAD_COUNTS:
+            movesPerSecond, failure = runWorms(numThreads, SECONDS_PER_RUN, False)
+            if failure is None:
+                failure = runWorms(numThreads, SECONDS_PER_RUN, True)[1] # the verification run
+            print('RESULT %s %s %s' % (numThreads, movesPerSecond, failure or ''))
+            sys.stdout.flush()
+        return
+
+    interpreters = [sys.executable] + sys.argv[1:]
+
+    # Each benchmark runs in a separate process, since the GIL can only be
+    # turned on or off when Python starts up.
+    results = [] # a list of (label, {numThreads: (movesPerSecond, failure)}) tuples
+    for interpreter in interpreters:
+        if isFreeThreaded(interpreter):
+            # The -X gil=0 option keeps the GIL off even after Pygame is
+            # imported. (Pygame isn't marked as safe for free-threading, so
+            # importing it would normally turn the GIL back on.) This is fine
+            # because the worm threads never call any Pygame functions.
+            configs = [('%s (GIL)' % interpreter, ['-X', 'gil=1']),
+                       ('%s (free-threaded)' % interpreter, ['-X', 'gil=0'])]
+        else:
+            configs = [('%s (GIL)' % interpreter, [])]
+
+        for label, options in configs:
+            print('Running %s...' % (label))
+            results.append((label, runChild(interpreter, options)))
+
+    printResults(results)
+
+
+def isFreeThreaded(interpreter):
+    # Return True if interpreter is a free-threaded build of Python.
+    output = subprocess.check_output([interpreter, '-c', 'import sysconfig; print(sysconfig.get_config_var("Py_GIL_DISABLED"))'])
+    return output.decode().strip() == '1'
+
+
+def runChild(interpreter, options):
+    # Run this script with --child in another Python process, and return a
+    # dictionary of its results.
+    #
+    # Pygame prints a "Hello from the pygame community" message when it's
+    # imported, so we tell it not to, and also only read the lines that
+    # start with RESULT in case anything else gets printed.
+    env = dict(os.environ)
+    env['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+    output = subprocess.check_output([interpreter] + options + [__file__, '--child'], env=env)
+    runResults = {}
+    for line in output.decode().splitlines():
+        if not line.startswith('RESULT '):
+            continue
+        parts = line.split(' ', 3)
+        if parts[1] == 'gil':
+            runResults['gil'] = parts[2] == 'True'
+        else:
+            runResults[int(parts[1])] = (float(parts[2]), parts[3])
+    return runResults
+
+
+def runWorms(numThreads, seconds, checkWhileRunning):
+    # Run numThreads worms for the given number of seconds, and return a
+    # tuple of the total moves per second they made and the checkGrid()
+    # failure message (or None if the grid never had a problem). If
+    # checkWhileRunning is True, a GridChecker thread checks the grid the
+    # whole time the worms run. Otherwise the grid is only checked once the
+    # worms have stopped.
+    threadworms.clearGrid()
+    threadworms.WORMS_RUNNING = True
+
+    # A speed of 0 means the worms don't wait between moves, so we measure
+    # how fast the threads can go instead of how long they sleep.
+    worms = []
+    for i in range(numThreads):
+        worms.append(threadworms.Worm(name='Worm %s' % i, speed=0))
+    checker = None
+    if checkWhileRunning:
+        checker = threadworms.GridChecker(worms)
+
+    startTime = time.time()
+    for worm in worms:
+        worm.start()
+    if checker is not None:
+        checker.start()
+    time.sleep(seconds)
+    threadworms.WORMS_RUNNING = False # tell all the threads to stop
+    for worm in worms:
+        worm.join() # wait for the thread to stop
+    elapsed = time.time() - startTime
+
+    failure = None
+    if checker is not None:
+        checker.join()
+        failure = checker.failure
+
+    # Check one last time now that everything has stopped.
+    if failure is None:
+        try:
+            threadworms.checkGrid(worms)
+        except threadworms.GridCheckError as err:
+            failure = str(err)
+
+    totalMoves = 0
+    for worm in worms:
+        totalMoves += worm.movesMade
+    return totalMoves / elapsed, failure
+
+
+def printResults(results):
+    print()
+    print('Total moves/sec by number of worm threads (timed without the grid checker running):')
+    for label, runResults in results:
+        print()
+        print(label)
+        if runResults['gil']:
+            print('  (the GIL was enabled while this ran)')
+        else:
+            print('  (the GIL was disabled while this ran)')
+        for numThreads in THREAD_COUNTS:
+            movesPerSecond, failure = runResults[numThreads]
+            line = '%4s threads: %10.0f' % (numThreads, movesPerSecond)
+            if failure:
+                line += '  GRID CHECK FAILED: %s' % (failure)
+            else:
+                line += '  grid check passed'
+            print(line)
+
+
+if __name__ == '__main__':
+    main()